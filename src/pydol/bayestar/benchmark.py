@@ -0,0 +1,276 @@
+"""
+    Scaling benchmark for SFH
+
+    Synthetic isochrone grids and catalogs are generated from the bundled
+    Isochrone.test files, every stage is timed through the SFH progress
+    events and one JSON line per case is appended to the results file.
+
+    python -m pydol.bayestar.benchmark --stars 1000 10000 --ages 10 100 --out bench.jsonl
+    python -m pydol.bayestar.benchmark --compare base.jsonl new.jsonl
+"""
+from numpy import array, concatenate, interp, linspace, loadtxt, savetxt, searchsorted, random, clip, \
+                __version__ as numpy_version
+import argparse, glob, json, os, platform, subprocess, sys, tempfile, time
+import multiprocessing as mp
+import pandas as pd
+
+from .run import SFH, data_dir
+
+iso_template_dir = f'{data_dir}/test_files/Isochrone.test'
+iso_header = 'ph      mass       F435W       F555W       F814W        Z        Log_AGE'
+
+def make_isochrones(out_dir, n_ages, template_dir=iso_template_dir):
+    """
+        Writes n_ages isochrones evenly spaced in log age over the range
+        of the templates. Each one mixes the two templates bracketing its
+        age, point by point along the track (resampled to a common length).
+
+        Parameters
+        ----------
+        out_dir: str,
+                 output directory, reused if it already holds n_ages files
+        n_ages: int,
+                number of isochrones
+        template_dir: str,
+                      directory of '.isoc' templates (PARSEC layout)
+
+        Returns
+        -------
+        out_dir: str
+    """
+    if len(glob.glob(os.path.join(out_dir, '*.isoc'))) == n_ages:
+        return out_dir
+    os.makedirs(out_dir, exist_ok=True)
+
+    temps = [loadtxt(k) for k in glob.glob(os.path.join(template_dir, '*.isoc'))]
+    temps = sorted(temps, key=lambda t: t[0, -1])
+    t_ages = array([t[0, -1] for t in temps])
+
+    for n, age in enumerate(linspace(t_ages[0], t_ages[-1], n_ages)):
+        k = min(max(searchsorted(t_ages, age) - 1, 0), len(temps) - 2)
+        f = (age - t_ages[k])/(t_ages[k+1] - t_ages[k])
+        a, b = temps[k], temps[k+1]
+        u = linspace(0, 1, len(a))
+        b = array([interp(u, linspace(0, 1, len(b)), col) for col in b.T]).T
+        iso = (1 - f)*a + f*b
+        iso[:, -1] = age
+        name = '%d_PARSEC1.1_Z%.4f_logAGE%.4fMyr_HST_BVI.isoc' % (n, iso[0, -2], age)
+        savetxt(os.path.join(out_dir, name), iso, fmt='%.6f', header=iso_header)
+    return out_dir
+
+def make_catalog(n_stars, iso_dir, dismod=29.67, fw_lim=30., seed=1234):
+    """
+        Synthetic catalog of n_stars drawn from the isochrones in iso_dir,
+        in the column layout SFH expects (RA, DEC, fw1, fw1_error, ...)
+
+        Stars are drawn uniformly over the isochrone points, shifted by
+        dismod and scattered by their magnitude errors. Only stars with
+        every magnitude below fw_lim are kept, so SFH selects all of them.
+
+        Returns
+        -------
+        df: pandas.DataFrame
+    """
+    rng = random.default_rng(seed)
+    pts = concatenate([loadtxt(k) for k in sorted(glob.glob(os.path.join(iso_dir, '*.isoc')))])
+
+    out, n = [], 0
+    while n < n_stars:
+        p = pts[rng.integers(0, len(pts), 2*(n_stars - n) + 100)]
+        mags = p[:, 2:5] + dismod
+        err = clip(0.01*10**(0.2*(mags - fw_lim + 3)), 0.005, 0.3)
+        mags = mags + err*rng.standard_normal(mags.shape)
+        keep = (mags < fw_lim).all(axis=1)
+        out.append(concatenate([mags[keep], err[keep]], axis=1))
+        n += keep.sum()
+    cat = concatenate(out)[:n_stars]
+
+    df = pd.DataFrame({'RA': 24.17 + 0.01*rng.random(n_stars),
+                       'DEC': 15.78 + 0.01*rng.random(n_stars)})
+    for k in range(3):
+        df[f'fw{k+1}'], df[f'fw{k+1}_error'] = cat[:, k], cat[:, 3+k]
+    return df
+
+def git_commit():
+    """Commit of the pydol checkout, if it is a git repository"""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_case(n_stars, n_ages, work_dir, sampler='map', seed=1234, **kwargs):
+    """
+        Times one SFH run on a synthetic catalog
+
+        Parameters
+        ----------
+        n_stars: int,
+                 catalog size
+        n_ages: int,
+                number of isochrones
+        work_dir: str,
+                  directory for the isochrones, caches and outputs
+        sampler: str,
+                 'map' or 'stan', see SFH
+        kwargs: dict,
+                further SFH settings (block_mem, n_proc, n_sig, ...)
+
+        Returns
+        -------
+        record: dict,
+                case settings, elapsed seconds per stage, throughput and
+                peak RSS (MB) of the process and of the pool workers
+    """
+    iso_dir = make_isochrones(os.path.join(work_dir, f'iso_{n_ages}'), n_ages)
+    df = make_catalog(n_stars, iso_dir, seed=seed)
+
+    events = []
+    kwargs = {'pc_cache': False, 'N_wlk': 4, 'N_smp': 200, **kwargs}
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        t0 = time.time()
+        sfh = SFH(df=df, isodir=iso_dir, sampler=sampler, progress=events.append,
+                  iso_cache_dir=os.path.join(work_dir, 'iso_cache'), **kwargs)
+        ID = 'bench_%d_%d' % (n_stars, n_ages)
+        if sfh.fused:
+            sfh.P_ij, sfh.C_ij, name = sfh.PC_ij_map(ID)
+        else:
+            sfh.P_ij, name = sfh.P_ij_map(ID)
+            sfh.C_ij = sfh.C_ij_map(ID)
+        if sampler == 'map':
+            sfh.ai_map(ID, '', n_boot=sfh.n_boot)
+        else:
+            sfh.ai_samp(ID, '')
+        total = time.time() - t0
+    finally:
+        os.chdir(cwd)
+
+    stages = {}
+    for e in events:
+        if e['event'] == 'stage_end':
+            stages[e['stage']] = stages.get(e['stage'], 0.) + e['elapsed']
+    rates = [e['rows_per_s'] for e in events if e['event'] == 'progress']
+    return {'n_stars': int(n_stars), 'n_ages': int(n_ages), 'sampler': sampler,
+            'n_rows': int(sfh.N_dat), 'n_points': int(sfh.iso_grid()[0].shape[1]),
+            'settings': {k: v for k, v in kwargs.items() if isinstance(v, (int, float, str, bool, type(None)))},
+            'stages': stages, 'total': total,
+            'rows_per_s': rates[-1] if len(rates) > 0 else None,
+            'peak_rss_mb': max(e['peak_rss_mb'] for e in events),
+            'peak_rss_children_mb': max(e['peak_rss_children_mb'] for e in events),
+            'commit': git_commit(), 'time': time.time(), 'host': platform.node(),
+            'python': platform.python_version(), 'numpy': numpy_version,
+            'cpus': mp.cpu_count()}
+
+def _run_case_to_file(out, args, kwargs):
+    record = run_case(*args, **kwargs)
+    with open(out, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+def run_benchmark(n_stars=(1000, 10000), n_ages=(10, 100), out='bayestar_bench.jsonl',
+                  work_dir=None, sampler='map', **kwargs):
+    """
+        Runs every (n_stars, n_ages) case and appends its record to out.
+        Each case runs in a fresh process, so peak RSS is per case.
+
+        Parameters
+        ----------
+        n_stars, n_ages: list,
+                         catalog sizes and isochrone grid sizes
+        out: str,
+             JSON-lines results file
+        work_dir: str,
+                  directory for the synthetic inputs (default: a temporary one)
+        sampler: str,
+                 'map' or 'stan'
+        kwargs: dict,
+                further SFH settings
+
+        Returns
+        -------
+        records: list
+    """
+    tmp = None
+    if work_dir is None:
+        tmp = tempfile.TemporaryDirectory()
+        work_dir = tmp.name
+    work_dir = os.path.abspath(work_dir)
+    out = os.path.abspath(out)
+    n_old = len(load_results(out)) if os.path.exists(out) else 0
+
+    ctx = mp.get_context('spawn')
+    try:
+        for a in n_ages:
+            for n in n_stars:
+                print("Benchmark: %d stars, %d isochrones" % (n, a))
+                p = ctx.Process(target=_run_case_to_file,
+                                args=(out, (int(n), int(a), work_dir), {'sampler': sampler, **kwargs}))
+                p.start()
+                p.join()
+                if p.exitcode != 0:
+                    raise Exception("Benchmark case (%d stars, %d isochrones) failed" % (n, a))
+    finally:
+        if tmp is not None:
+            tmp.cleanup()
+    return load_results(out)[n_old:]
+
+def load_results(filename):
+    """Records of a JSON-lines results file"""
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def compare(base, new, tol=1.2):
+    """
+        Compares the stage timings of two results files, matching cases
+        by (n_stars, n_ages, sampler). The last record of a case is used.
+
+        Parameters
+        ----------
+        base, new: str,
+                   JSON-lines results files (e.g. from two commits)
+        tol: float,
+             slowdown ratio above which a stage counts as a regression
+
+        Returns
+        -------
+        regressions: list,
+                     (n_stars, n_ages, sampler, stage, base_s, new_s) tuples
+    """
+    key = lambda r: (r['n_stars'], r['n_ages'], r['sampler'])
+    b = {key(r): r for r in load_results(base)}
+    regressions = []
+    print("%9s %6s %-11s %10s %10s %7s" % ('stars', 'ages', 'stage', 'base (s)', 'new (s)', 'ratio'))
+    for r in load_results(new):
+        if key(r) not in b:
+            continue
+        stages = dict(b[key(r)]['stages'], total=b[key(r)]['total'])
+        for stage, t_new in dict(r['stages'], total=r['total']).items():
+            if stage not in stages:
+                continue
+            ratio = t_new/max(stages[stage], 1e-9)
+            flag = ' <--' if ratio > tol else ''
+            print("%9d %6d %-11s %10.3f %10.3f %7.2f%s" %
+                  (r['n_stars'], r['n_ages'], stage, stages[stage], t_new, ratio, flag))
+            if ratio > tol:
+                regressions.append((*key(r), stage, stages[stage], t_new))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='bayestar SFH scaling benchmark')
+    parser.add_argument('--stars', type=float, nargs='+', default=[1e3, 1e4], help='catalog sizes')
+    parser.add_argument('--ages', type=int, nargs='+', default=[10, 100], help='isochrone grid sizes')
+    parser.add_argument('--out', default='bayestar_bench.jsonl', help='JSON-lines results file')
+    parser.add_argument('--work-dir', default=None, help='directory for the synthetic inputs')
+    parser.add_argument('--sampler', default='map', choices=['map', 'stan'])
+    parser.add_argument('--n-proc', type=int, default=None)
+    parser.add_argument('--block-mem', type=float, default=64.)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help='compare two results files instead of running')
+    parser.add_argument('--tol', type=float, default=1.2, help='regression threshold for --compare')
+    args = parser.parse_args()
+
+    if args.compare:
+        sys.exit(1 if len(compare(*args.compare, tol=args.tol)) > 0 else 0)
+    run_benchmark([int(n) for n in args.stars], args.ages, out=args.out, work_dir=args.work_dir,
+                  sampler=args.sampler, n_proc=args.n_proc, block_mem=args.block_mem)
@@ -1,18 +1,26 @@
 from numpy import append, array, exp, \
                 linspace, loadtxt, log10, pi, meshgrid, \
-                savetxt, sqrt, where, ones, percentile,trapz, all
+                savetxt, sqrt, where, ones, percentile,trapz, all, \
+                add, concatenate, cumsum, diff, empty_like, multiply, \
+                subtract, zeros, ascontiguousarray, asarray, empty, save, \
+                divide, log, random, arange, argsort, bincount, repeat, searchsorted, \
+                floor, unique
+from numpy.lib.format import open_memmap
 from scipy import special
 import matplotlib.pyplot as plt
-import time, glob, os, sys
+import time, glob, os, sys, hashlib, copy, json, dataclasses, resource, contextlib
 import multiprocessing as mp
 from pathlib import Path
 
 import stan
+from stan.model import DataJSONEncoder
+
+from . import kernels
 
 code = """
 
     functions{
-        real P(int N1, int N2, vector v, matrix M) {
+        real P(int N1, int N2, vector v, matrix M, vector w) {
             vector[N1] Mj;
             vector[N1] ln_Mj;
 
@@ -22,7 +30,7 @@ code = """
                     Mj[j] = 1.;
             }
             ln_Mj = log(Mj);
-            return sum(ln_Mj);
+            return dot_product(w, ln_Mj);
         }
     }
 
@@ -31,6 +39,7 @@ code = """
         int<lower=0> Ni; // number of isochrones
         matrix[Nj,Ni] Pij; // Probability matrix
         matrix[Nj,Ni] Cij; // Normalization matrix
+        vector<lower=0>[Nj] wj; // number of stars behind each row
     }
 
     parameters {
@@ -39,12 +48,30 @@ code = """
 
     model {
         target += dirichlet_lpdf(a | rep_vector(1., Ni));
-        target += P(Nj,Ni,a,Pij);
-        target += -1.*P(Nj,Ni,a,Cij);
+        target += P(Nj,Ni,a,Pij,wj);
+        target += -1.*P(Nj,Ni,a,Cij,wj);
     }
 
     """
 
+_shared = None
+_stan_models = {}
+
+def _pool_init(sfh):
+    """
+        Worker initializer. The SFH instance (photometry and isochrone grid)
+        is handed over once per worker (inherited at fork time on Linux),
+        so each task message only carries a method name and a row range.
+    """
+    global _shared
+    _shared = sfh
+    if getattr(sfh, '_jit_threads', None) is not None:
+        kernels.set_threads(sfh._jit_threads)
+
+def _pool_task(task):
+    name, rows = task
+    return getattr(_shared, name)(rows)
+
 class Base():
     """Base Class for Bayesian Star-Formation History using
         PyStan (Jairo Alzate (2023))"""
@@ -90,36 +117,674 @@ class Base():
 
         return(imf)
 
+    def IMF_p(self, m):
+        """IMF selected by self.IMF evaluated at masses m"""
+        if self.IMF == "Slp":
+            raise Exception("Salpeter IMF (Slp) not available at the moment")
+        # Default
+        return self.IMF_Krp(m)
 
-    def P_ij_map(self, IDp):
-        fw1_lim = self.fw_lims[0]
-        fw2_lim = self.fw_lims[1]
-        fw3_lim = self.fw_lims[2]
+    def trapz_weights(self, x):
+        """
+            Weights w such that sum(w*y) == trapz(y, x)
+
+            Parameters
+            ----------
+            x: array,
+               integration grid (isochrone masses)
+        """
+        w = zeros(len(x))
+        dx = 0.5*diff(x)
+        w[:-1] += dx
+        w[1:] += dx
+        return w
+
+    def iso_grid(self):
+        """
+            All isochrone points flattened into contiguous arrays.
+            Built once per instance and reused by every row block.
+
+            Returns
+            -------
+            mags: array (N_mags, N_pts),
+                  isochrone magnitudes of every point
+            w: array (N_pts),
+               IMF x trapezoid quadrature weights
+            starts: array,
+                    first point of each non-empty isochrone
+            cols: array,
+                  isochrone index of each entry in starts
+        """
+        if getattr(self, '_iso_grid', None) is None:
+            sizes = array([len(iso[1]) for iso in self.Iso], dtype=int)
+            mags = concatenate([iso[2:2+self.N_mags] for iso in self.Iso], axis=1).astype(float)
+            w = concatenate([self.IMF_p(iso[1])*self.trapz_weights(iso[1])
+                             for iso in self.Iso]).astype(float)
+            cols = where(sizes > 0)[0]
+            starts = (cumsum(sizes) - sizes)[cols]
+            self._iso_grid = (mags, w, starts, cols)
+        return self._iso_grid
+
+    def block_budget(self):
+        """
+            Memory (MB) available to one row block: self.block_mem, lowered
+            so that every worker plus the main process fit in self.max_rss
+        """
+        block_mem = getattr(self, 'block_mem', 64.)
+        if getattr(self, 'max_rss', None) is not None:
+            n_proc = getattr(self, 'n_proc', None) or max(mp.cpu_count()-1, 1)
+            block_mem = min(block_mem, self.max_rss/(n_proc + 1))
+        return block_mem
+
+    def row_blocks(self):
+        """
+            Splits the N_dat stars into (j0, j1) row blocks whose
+            (rows x isochrone points) temporaries fit in block_budget MB
+        """
+        mags = self.iso_grid()[0]
+        # ~4 live (rows, N_pts) float64 arrays while evaluating a block
+        n_rows = int(self.block_budget()*2**20/(32.*max(mags.shape[1], 1)))
+        n_rows = max(n_rows, 1)
+        return [(j0, min(j0 + n_rows, self.N_dat)) for j0 in range(0, self.N_dat, n_rows)]
+
+    def iso_sum(self, intg):
+        """Sums a (rows, N_pts) weighted integrand per isochrone"""
+        mags, w, starts, cols = self.iso_grid()
+        out = zeros((len(intg), self.NIso))
+        if len(cols) > 0:
+            out[:, cols] = add.reduceat(intg, starts, axis=1)
+        return out
+
+    def band_block(self, rows):
+        """
+            Star magnitudes, errors and isochrone tolerances of a block of
+            stars shaped (bands, stars, 1), so that band k broadcasts
+            against the isochrone magnitudes mags[k]
+        """
+        j0, j1 = rows
+        fw = self.dat[2::2][:self.N_mags, j0:j1, None]
+        fw_err = self.dat[3::2][:self.N_mags, j0:j1, None]
+        sig_i2 = (asarray(self.sig_fw[:self.N_mags], dtype=float)**2)[:, None, None]
+        return fw, fw_err, sig_i2
+
+    def phi_block(self, rows):
+        """
+            Completeness x IMF x trapezoid weights for a block of stars
+            against all isochrone points, i.e. the Cij integrand
+
+            Parameters
+            ----------
+            rows: tuple,
+                  (j0, j1) star rows to evaluate
+
+            Returns
+            -------
+            phis: array (j1-j0, N_pts)
+        """
+        j0, j1 = rows
+        mags, w, starts, cols = self.iso_grid()
+        fw, fw_err, sig_i2 = self.band_block(rows)
+
+        phis = w*ones((j1 - j0, 1))
+        t = empty_like(phis)
+        for k in range(self.N_mags):
+            # Same terms as Phi_MGk, evaluated in place one band at a time
+            b = sig_i2[k] + fw_err[k]*fw_err[k]
+            multiply(fw_err[k]*fw_err[k]/b, mags[k], out=t)
+            subtract(self.fw_lims[k] - sig_i2[k]/b*fw[k], t, out=t)
+            t *= sqrt(b)/sig_i2[k]
+            special.ndtr(t, out=t)
+            phis *= t
+        return phis
+
+    def P_ij_block(self, rows):
+        """
+            Pij for a block of stars against all isochrones at once
+
+            Parameters
+            ----------
+            rows: tuple,
+                  (j0, j1) star rows to evaluate
+
+            Returns
+            -------
+            Pij: array (j1-j0, NIso)
+        """
+        if getattr(self, 'n_sig', None) is not None:
+            return self.P_ij_pruned(rows)
+        if self.jit():
+            return self.jit_block(rows, do_C=False)[0]
+        return self.iso_sum(self.normal_block(rows, self.phi_block(rows)))
+
+    def jit(self):
+        """
+            Whether row blocks go through the compiled kernel (kernels.pc_block):
+            self.backend 'numba', or 'auto' when numba is installed
+        """
+        backend = getattr(self, 'backend', 'numpy')
+        if backend == 'numba' and not kernels.HAS_NUMBA:
+            raise Exception("backend='numba' needs numba installed")
+        return backend in ['auto', 'numba'] and kernels.HAS_NUMBA
+
+    def jit_block(self, rows, do_P=True, do_C=True):
+        """
+            Pij and/or Cij for a block of stars with the fused, compiled
+            kernel; same integrand and quadrature as the NumPy blocks
+
+            Returns
+            -------
+            Pij, Cij: arrays (j1-j0, NIso), zeros where not requested
+        """
+        j0, j1 = rows
+        mags, w, starts, cols = self.iso_grid()
+        fw, fw_err, sig_i2 = self.band_block(rows)
+        ends = append(starts[1:], mags.shape[1]).astype(starts.dtype)
+        Pij, Cij = zeros((j1 - j0, self.NIso)), zeros((j1 - j0, self.NIso))
+        kernels.pc_block(ascontiguousarray(fw[:, :, 0], dtype=float), ascontiguousarray(fw_err[:, :, 0], dtype=float),
+                         ascontiguousarray(sig_i2[:, 0, 0]), asarray(self.fw_lims[:self.N_mags], dtype=float),
+                         mags, w, starts, ends, cols, Pij, Cij, do_P, do_C)
+        return Pij, Cij
+
+    def ref_band(self):
+        """Band used to index isochrone points: fw2, or fw1 with a single band"""
+        return min(1, self.N_mags - 1)
+
+    def iso_index(self):
+        """
+            Isochrone points sorted by their magnitude in the reference
+            band, so the points near a star can be found with a binary search
+
+            Returns
+            -------
+            order: array,
+                   point indices sorted by reference band magnitude
+            mags_sorted: array,
+                         reference band magnitude of the sorted points
+            labels: array,
+                    isochrone index of every point
+        """
+        grid = self.iso_grid()
+        if getattr(self, '_iso_index', None) is None or self._iso_index[0] is not grid:
+            mags, w, starts, cols = grid
+            sizes = diff(append(starts, mags.shape[1]))
+            labels = repeat(cols, sizes)
+            r = self.ref_band()
+            order = argsort(mags[r], kind='stable')
+            self._iso_index = (grid, (order, mags[r][order], labels))
+        return self._iso_index[1]
+
+    def P_ij_pruned(self, rows, phis=None):
+        """
+            Pij for a block of stars using only the isochrone points within
+            self.n_sig sigma of each star in the reference band (ref_band).
+            The neglected part of every Pij is bounded by P_ij_bound.
+
+            Parameters
+            ----------
+            rows: tuple,
+                  (j0, j1) star rows to evaluate
+            phis: array (j1-j0, N_pts),
+                  completeness integrand if already evaluated (fused mode)
+
+            Returns
+            -------
+            Pij: array (j1-j0, NIso)
+        """
+        j0, j1 = rows
+        mags, w, starts, cols = self.iso_grid()
+        order, mags_sorted, labels = self.iso_index()
+        r = self.ref_band()
+        fw, fw_err, sig_i2 = [x[:, :, 0].T for x in self.band_block(rows)]
+        sig2 = fw_err*fw_err + sig_i2
+
+        half = self.n_sig*sqrt(sig2[:, r])
+        lo = searchsorted(mags_sorted, fw[:, r] - half, 'left')
+        hi = searchsorted(mags_sorted, fw[:, r] + half, 'right')
+
+        # (star, point) pairs inside the window, flattened
+        counts = hi - lo
+        star = repeat(arange(j1 - j0), counts)
+        pts = order[arange(counts.sum()) + repeat(lo - (cumsum(counts) - counts), counts)]
+
+        fw_p, err2_p, sig2_p, mags_p = fw[star], fw_err[star]**2, sig2[star], mags[:, pts].T
+        chi2 = ((fw_p - mags_p)**2/sig2_p).sum(axis=1)
+        norm = sqrt(2.*pi*sig2).prod(axis=1)
+        if phis is None:
+            b = sig2_p
+            fw_lims = asarray(self.fw_lims[:self.N_mags], dtype=float)[None, :]
+            t = (fw_lims - sig_i2/b*fw_p - err2_p/b*mags_p)*sqrt(b)/sig_i2
+            intg = w[pts]*special.ndtr(t).prod(axis=1)
+        else:
+            intg = phis[star, pts]
+        intg = intg*exp(-0.5*chi2)/norm[star]
+
+        return bincount(star*self.NIso + labels[pts], weights=intg,
+                        minlength=(j1 - j0)*self.NIso).reshape(j1 - j0, self.NIso)
+
+    def P_ij_bound(self, rows):
+        """
+            Upper bound on the Pij contribution left out by P_ij_pruned:
+            every skipped point has a reference band Gaussian below exp(-n_sig^2/2) of
+            its peak, the other terms are bounded by their peaks (completeness
+            by 1), and the skipped IMF weights by the isochrone's total.
+
+            Returns
+            -------
+            bound: array (j1-j0, NIso)
+        """
+        mags, w, starts, cols = self.iso_grid()
+        fw, fw_err, sig_i2 = self.band_block(rows)
+
+        norm = sqrt(2.*pi*(fw_err*fw_err + sig_i2)).prod(axis=0)[:, 0]
+        W = self.iso_sum(w[None, :])[0]
+        return exp(-0.5*self.n_sig**2)*W[None, :]/norm[:, None]
+
+    def report_bound(self, Pij):
+        """Prints and stores the pruning error bound of a Pij matrix"""
+        err, rel = 0., 0.
+        for j0, j1 in self.matrix_blocks(Pij):
+            bound = self.P_ij_bound((j0, j1)).max(axis=1)
+            row_max = asarray(Pij[j0:j1]).max(axis=1)
+            err = max(err, float(bound.max(initial=0.)))
+            rel = max(rel, float(divide(bound, row_max, out=zeros(len(bound)), where=row_max > 0).max(initial=0.)))
+        self.prune_err = (err, rel)
+        print("\tPij pruned at %.1f sigma: error <= %.3e (<= %.3e of each star's largest Pij)" %
+              (self.n_sig, *self.prune_err))
+
+    def normal_block(self, rows, intg):
+        """
+            Multiplies intg in place by the N-band Gaussian likelihood
+            (Normal_MGk) of a block of stars at every isochrone point
+        """
+        mags = self.iso_grid()[0]
+        fw, fw_err, sig_i2 = self.band_block(rows)
+
+        sig2 = fw_err*fw_err + sig_i2
+        chi2 = zeros(intg.shape)
+        t = empty_like(intg)
+        for k in range(self.N_mags):
+            subtract(fw[k], mags[k], out=t)
+            t *= t
+            t /= sig2[k]
+            chi2 += t
+        chi2 *= -0.5
+        exp(chi2, out=chi2)
+        chi2 /= sqrt(2.*pi*sig2).prod(axis=0)
+        intg *= chi2
+        return intg
+
+    def C_ij_block(self, rows):
+        """
+            Cij for a block of stars against all isochrones at once
+
+            Parameters
+            ----------
+            rows: tuple,
+                  (j0, j1) star rows to evaluate
+
+            Returns
+            -------
+            Cij: array (j1-j0, NIso)
+        """
+        if self.jit():
+            return self.jit_block(rows, do_P=False)[1]
+        return self.iso_sum(self.phi_block(rows))
+
+    def PC_ij_block(self, rows):
+        """
+            Pij and Cij for a block of stars in a single pass. The
+            completeness and IMF terms are evaluated once and shared.
+
+            Parameters
+            ----------
+            rows: tuple,
+                  (j0, j1) star rows to evaluate
+
+            Returns
+            -------
+            Pij, Cij: arrays (j1-j0, NIso)
+        """
+        if self.jit() and getattr(self, 'n_sig', None) is None:
+            return self.jit_block(rows)
+        phis = self.phi_block(rows)
+        Cij = self.iso_sum(phis)
+        if getattr(self, 'n_sig', None) is not None:
+            return self.P_ij_pruned(rows, phis), Cij
+        Pij = self.iso_sum(self.normal_block(rows, phis))
+        return Pij, Cij
+
+    def pool(self):
+        """Process pool sharing this instance with every worker"""
+        self.iso_grid()
+        n_proc = getattr(self, 'n_proc', None) or max(mp.cpu_count()-1, 1)
+        # Progress callbacks stay in the main process, and the compiled
+        # kernel's threads are split between the workers
+        shared = copy.copy(self)
+        shared.progress = shared.progress_log = None
+        shared._jit_threads = max(mp.cpu_count()//n_proc, 1) if self.jit() else None
+        return mp.Pool(n_proc, initializer=_pool_init, initargs=(shared,))
+
+    def emit(self, event, **fields):
+        """
+            Sends a progress event to the self.progress callback and appends
+            it to the self.progress_log JSON-lines file
+
+            Parameters
+            ----------
+            event: str,
+                   'stage_start', 'stage_end', 'progress' or 'done'
+            fields: dict,
+                    event data, e.g. stage, rows_done, rows_per_s, eta_s
+
+            The event also carries its time stamp and the peak RSS (MB) of
+            this process and of its finished children (pool workers).
+        """
+        callback, log = getattr(self, 'progress', None), getattr(self, 'progress_log', None)
+        if callback is None and log is None:
+            return
+        ev = {'event': event, 'time': time.time(), **fields,
+              'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10,
+              'peak_rss_children_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/2**10}
+        if callback is not None:
+            callback(ev)
+        if log is not None:
+            with open(log, 'a') as f:
+                f.write(json.dumps(ev) + '\n')
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """Emits stage_start/stage_end events (with elapsed seconds) around a block"""
+        t0 = time.time()
+        prev, self._stage = getattr(self, '_stage', None), name
+        self.emit('stage_start', stage=name, **fields)
+        try:
+            yield
+        finally:
+            self._stage = prev
+        self.emit('stage_end', stage=name, elapsed=time.time() - t0, **fields)
+
+    def pc_key(self):
+        """
+            Content hash of everything Pij/Cij depend on: star data (after
+            distance and extinction correction), isochrone grid and IMF
+            weights, tolerances, magnitude limits and model settings
+        """
+        mags, w, starts, cols = self.iso_grid()
+        h = hashlib.sha1()
+        for a in [self.dat, mags, w, starts, cols, self.sig_fw, self.fw_lims]:
+            h.update(ascontiguousarray(a, dtype=float).tobytes())
+        h.update(repr([self.IMF, getattr(self, 'dismod', None), getattr(self, 'n_sig', None),
+                       [float(x) for x in getattr(self, 'A_fw', [])], self.N_dat, self.NIso]).encode())
+        return h.hexdigest()[:20]
+
+    def block_map(self, task, kinds):
+        """
+            Runs a row-block task over all stars on the pool.
+
+            With self.pc_cache the matrices are written block by block into
+            '<pc_cache_dir>/<pc_key>/<kind>.npy'. Completed blocks are logged
+            in '<kind>.done', so an interrupted run resumes where it stopped
+            and an identical rerun returns the cached matrices directly.
+            With self.stream they are always written there and returned as
+            read-only memory maps instead of being loaded.
+
+            Parameters
+            ----------
+            task: str,
+                  Base method evaluating a row block, e.g. 'PC_ij_block'
+            kinds: list,
+                   names of the matrices returned by task, e.g. ['Pij', 'Cij']
+
+            Returns
+            -------
+            out: list,
+                 one (N_dat, NIso) array (or memory map) per kind
+        """
+        shape = (self.N_dat, self.NIso)
+        blocks = self.row_blocks()
+        stream = getattr(self, 'stream', False)
+
+        if not (getattr(self, 'pc_cache', False) or stream):
+            out = [zeros(shape) for k in kinds]
+            logs = None
+        else:
+            cache = os.path.join(getattr(self, 'pc_cache_dir', 'pij_cij_results'), self.pc_key())
+            os.makedirs(cache, exist_ok=True)
+            out, logs = [], []
+            done = ones(self.N_dat, dtype=bool)
+            for k in kinds:
+                fname, log = os.path.join(cache, f'{k}.npy'), os.path.join(cache, f'{k}.done')
+                if os.path.exists(fname) and os.path.exists(log):
+                    out.append(open_memmap(fname, mode='r+'))
+                    k_done = zeros(self.N_dat, dtype=bool)
+                    with open(log) as f:
+                        for line in f:
+                            j0, j1 = line.split()
+                            k_done[int(j0):int(j1)] = True
+                    done &= k_done
+                else:
+                    out.append(open_memmap(fname, mode='w+', dtype=float, shape=shape))
+                    open(log, 'w').close()
+                    done[:] = False
+                logs.append(log)
+            blocks = [(j0, j1) for j0, j1 in blocks if not done[j0:j1].all()]
+            if len(blocks) == 0:
+                print("\tUsing cached %s from %s" % (', '.join(kinds), cache))
+            elif done.any():
+                print("\tResuming %s: %d rows left" % (', '.join(kinds), self.N_dat - done.sum()))
+
+        if len(blocks) > 0:
+            stage = getattr(self, '_stage', None) or task
+            n_todo, n_done, t0 = sum(j1 - j0 for j0, j1 in blocks), 0, time.time()
+            with self.pool() as p:
+                for (j0, j1), res in zip(blocks, p.imap(_pool_task, [(task, rows) for rows in blocks])):
+                    if len(kinds) == 1:
+                        res = [res]
+                    for m, r in zip(out, res):
+                        m[j0:j1] = r
+                    if logs is not None:
+                        for m, log in zip(out, logs):
+                            m.flush()
+                            with open(log, 'a') as f:
+                                f.write('%d %d\n' % (j0, j1))
+
+                    n_done += j1 - j0
+                    rate = n_done/max(time.time() - t0, 1e-9)
+                    eta = (n_todo - n_done)/rate
+                    self.emit('progress', stage=stage, rows_done=n_done, rows_total=n_todo,
+                              rows_per_s=rate, eta_s=eta)
+                    print("\r\t%s: %d/%d rows, %.0f rows/s, ETA %02d:%02d:%02d" %
+                          (stage, n_done, n_todo, rate, int(eta/3600), int(eta % 3600/60), eta % 60),
+                          end='', flush=True)
+            print()
 
-        sig_i = self.sig_fw[0]
+        if logs is not None:
+            with open(os.path.join(cache, 'meta.json'), 'w') as f:
+                json.dump(self.pc_meta(), f, indent=1)
 
+        if stream:
+            del out
+            print("\tPeak RSS: %.1f MB" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**10))
+            return [open_memmap(os.path.join(cache, f'{k}.npy'), mode='r') for k in kinds]
+        return [array(m) for m in out]
+
+    def matrix_blocks(self, M):
+        """
+            (j0, j1) row blocks of an (N, NIso) matrix of at most
+            block_budget MB, so that memory-mapped Pij/Cij are read from
+            disk a block at a time
+        """
+        n_rows = max(int(self.block_budget()*2**20/(8.*max(M.shape[1], 1))), 1)
+        return [(j0, min(j0 + n_rows, len(M))) for j0 in range(0, len(M), n_rows)]
+
+    def subset(self, dat=None, Iso=None, w_dat=None):
+        """
+            Shallow copy of this instance restricted to other stars and/or
+            isochrones, used to compute only the missing rows or columns
+        """
+        sub = copy.copy(self)
+        if dat is not None:
+            sub.dat, sub.N_dat = dat, len(dat[0])
+            sub.w_dat = ones(sub.N_dat) if w_dat is None else asarray(w_dat, dtype=float)
+        if Iso is not None:
+            sub.Iso, sub.NIso = Iso, len(Iso)
+            sub._iso_grid = None
+        return sub
+
+    def add_rows(self, dat, Pij=None, Cij=None, w_dat=None):
+        """
+            Appends stars and computes only their Pij/Cij rows
+
+            Parameters
+            ----------
+            dat: array (8, N_new),
+                 corrected photometry of the new stars (see SFH.read_data)
+            Pij, Cij: arrays (N_dat, NIso),
+                      existing matrices (default: self.P_ij, self.C_ij)
+            w_dat: array (N_new),
+                   number of stars behind each new row (default: one)
+
+            Returns
+            -------
+            Pij, Cij: arrays (N_dat + N_new, NIso)
+        """
+        Pij = self.P_ij if Pij is None else Pij
+        Cij = self.C_ij if Cij is None else Cij
+        P_new, C_new = self.subset(dat=dat).block_map('PC_ij_block', ['Pij', 'Cij'])
+
+        if getattr(self, 'w_dat', None) is not None:
+            w_new = ones(len(dat[0])) if w_dat is None else asarray(w_dat, dtype=float)
+            self.w_dat = concatenate([self.w_dat, w_new])
+        self.dat = concatenate([self.dat, dat], axis=1)
+        self.N_dat = len(self.dat[0])
+        self.P_ij = concatenate([asarray(Pij), P_new], axis=0)
+        self.C_ij = concatenate([asarray(Cij), C_new], axis=0)
+        return self.P_ij, self.C_ij
+
+    def add_cols(self, Iso, Z_age_isos, Pij=None, Cij=None):
+        """
+            Appends isochrones and computes only their Pij/Cij columns
+
+            Parameters
+            ----------
+            Iso: object array,
+                 (7, n_i) array per new isochrone, as in self.Iso
+            Z_age_isos: array (N_new, 2),
+                        Z and log_age of the new isochrones
+            Pij, Cij: arrays (N_dat, NIso),
+                      existing matrices (default: self.P_ij, self.C_ij)
+
+            Returns
+            -------
+            Pij, Cij: arrays (N_dat, NIso + N_new)
+        """
+        Pij = self.P_ij if Pij is None else Pij
+        Cij = self.C_ij if Cij is None else Cij
+        P_new, C_new = self.subset(Iso=Iso).block_map('PC_ij_block', ['Pij', 'Cij'])
+
+        iso = empty(self.NIso + len(Iso), dtype=object)
+        iso[:self.NIso], iso[self.NIso:] = list(self.Iso), list(Iso)
+        self.Iso, self.NIso, self._iso_grid = iso, len(iso), None
+        self.Z_age_isos = concatenate([asarray(self.Z_age_isos, dtype=float),
+                                       asarray(Z_age_isos, dtype=float)], axis=0)
+        self.P_ij = concatenate([asarray(Pij), P_new], axis=1)
+        self.C_ij = concatenate([asarray(Cij), C_new], axis=1)
+        return self.P_ij, self.C_ij
+
+    def drop_rows(self, j, Pij=None, Cij=None):
+        """
+            Removes stars j (index or boolean mask) and their Pij/Cij rows
+        """
+        Pij = self.P_ij if Pij is None else Pij
+        Cij = self.C_ij if Cij is None else Cij
+        keep = ones(self.N_dat, dtype=bool)
+        keep[j] = False
+
+        self.dat = self.dat[:, keep]
+        self.N_dat = len(self.dat[0])
+        if getattr(self, 'w_dat', None) is not None:
+            self.w_dat = self.w_dat[keep]
+        self.P_ij, self.C_ij = asarray(Pij)[keep], asarray(Cij)[keep]
+        return self.P_ij, self.C_ij
+
+    def drop_cols(self, i, Pij=None, Cij=None):
+        """
+            Removes isochrones i (index or boolean mask) and their Pij/Cij columns
+        """
+        Pij = self.P_ij if Pij is None else Pij
+        Cij = self.C_ij if Cij is None else Cij
+        keep = ones(self.NIso, dtype=bool)
+        keep[i] = False
+
+        self.Iso, self._iso_grid = self.Iso[keep], None
+        self.NIso = len(self.Iso)
+        self.Z_age_isos = self.Z_age_isos[keep]
+        self.P_ij, self.C_ij = asarray(Pij)[:, keep], asarray(Cij)[:, keep]
+        return self.P_ij, self.C_ij
+
+    def row_args(self, j, filename=''):
+        """Argument list of P_ij_row_map/C_ij_row_map for the j-th star"""
+    #            0   1     2    3         4         5        6        7
+        return [j, self.dat, self.NIso, self.Iso, self.fw_lims, self.N_dat, filename, self.sig_fw,
+                self.IMF]
+    #                8
+
+    def P_ij_row(self, j):
+        return self.P_ij_row_map(self.row_args(j))
+
+    def C_ij_row(self, j):
+        return self.C_ij_row_map(self.row_args(j))
+
+    def pc_filename(self, ID, kind):
+        """Output name of the Pij/Cij matrix for run ID (without extension)"""
+        return '%s_%s_Data_LimMag%.2lf_%srows_%siso_IsoModel_sig%s_IMF_%s_Simple' % \
+            (ID,kind,self.fw_lims[self.ref_band()],str(self.N_dat),str(self.NIso),str(self.sig_fw[0]).replace('.','p'), self.IMF)
+
+    def pc_meta(self):
+        """Settings the Pij/Cij matrices were computed with"""
+        return {'N_dat': int(self.N_dat), 'NIso': int(self.NIso),
+                'sig_fw': [float(x) for x in self.sig_fw],
+                'fw_lims': [float(x) for x in self.fw_lims],
+                'IMF': self.IMF, 'dismod': float(getattr(self, 'dismod', 0.)),
+                'A_fw': [float(x) for x in getattr(self, 'A_fw', [])],
+                'engine': getattr(self, 'engine', 'numpy'), 'n_sig': getattr(self, 'n_sig', None),
+                'hess_tol': getattr(self, 'hess_tol', None),
+                'key': self.pc_key()}
+
+    def save_matrix(self, filename, M, cached=False):
+        """
+            Writes a Pij/Cij matrix to pij_cij_results as '.npy' with a
+            '.json' metadata file, unless it already lives in the Pij/Cij
+            cache. The text export is only written when self.text_out is set.
+        """
+        base = os.path.join('pij_cij_results', filename)
+        if not cached:
+            save(base + '.npy', M)
+            with open(base + '.json', 'w') as f:
+                json.dump(self.pc_meta(), f, indent=1)
+        if getattr(self, 'text_out', False):
+            savetxt(base + '.txt', M, fmt='%.17g')
+
+    def P_ij_map(self, IDp):
         if not os.path.exists('pij_cij_results'):
             os.mkdir('pij_cij_results')
 
-        filename_p = '%s_Pij_Data_LimMag%.2lf_%srows_%siso_IsoModel_sig%s_IMF_%s_Simple.txt' % \
-            (IDp,fw2_lim,str(self.N_dat),str(self.NIso),str(sig_i).replace('.','p'), self.IMF)    ## Opening file
-        fp = open(os.path.join("pij_cij_results",filename_p),'a')
-        args = []
-
-         ## Pij is calcutated row by row, i.e. fix j-th dat and run each i-th isochrone.
-
-        for j in range(self.N_dat):                       
-    #                    0   1     2    3     4         5        6      7       8        9     10
-            args.append([j, self.dat, self.NIso, self.Iso, 
-                         fw1_lim, fw2_lim, fw3_lim, self.N_dat, filename_p, sig_i, self.IMF])
-        with mp.Pool(mp.cpu_count()-1) as p:         ## Pooling Pij rows using all the abailable CPUs (Parallel computation)
-            results = p.map(self.P_ij_row_map, args)
-            Pij_out=[]
-            for [j,wr] in results:
-                fp.write('{}'.format(' '.join(wr))+'\n')
-                Pij_out.append(array(wr, dtype=float))
-        fp.close()
-        
+        filename_p = self.pc_filename(IDp, 'Pij')
+        cached = self.engine == 'numpy' and (getattr(self, 'pc_cache', False) or getattr(self, 'stream', False))
+
+        with self.stage('Pij', rows=self.N_dat, isochrones=self.NIso):
+            if self.engine == 'numpy':
+                ## Pij is calculated by blocks of rows against all isochrone points at once.
+                Pij_out, = self.block_map('P_ij_block', ['Pij'])
+                if getattr(self, 'n_sig', None) is not None:
+                    self.report_bound(Pij_out)
+            else:
+                ## Pij is calcutated row by row, i.e. fix j-th dat and run each i-th isochrone.
+                with self.pool() as p:         ## Pooling Pij rows using all the abailable CPUs (Parallel computation)
+                    results = p.map(_pool_task, [('P_ij_row', j) for j in range(self.N_dat)])
+                Pij_out = array([wr for [j,wr] in results]).reshape(self.N_dat, self.NIso)
+
+        self.save_matrix(filename_p, Pij_out, cached)
         return([Pij_out, filename_p])
 
     def P_ij_row_map(self, args):
@@ -129,22 +794,18 @@ class Base():
         Niso = args[2]
         Iso = args[3]
 
-        fw1_lim = args[4]
-        fw2_lim = args[5]
-        fw3_lim = args[6]
+        fw_lims = args[4]
 
-        Ndat = args[7]
-        filename_p = args[8]
-        sig_i = args[9]
-        imf = args[10]
-        
-        P_fw1 = self.Normal_MGk(self.dat[2][j],self.dat[3][j],sig_i)
-        P_fw2 = self.Normal_MGk(self.dat[4][j],self.dat[5][j],sig_i)
-        P_fw3 = self.Normal_MGk(self.dat[6][j],self.dat[7][j],sig_i)
+        Ndat = args[5]
+        filename_p = args[6]
+        sig_fw = args[7]
+        imf = args[8]
 
-        Phi_fw1 = self.Phi_MGk(self.dat[2][j], self.dat[3][j], fw1_lim, sig_i)
-        Phi_fw2 = self.Phi_MGk(self.dat[4][j], self.dat[5][j], fw2_lim, sig_i)
-        Phi_fw3 = self.Phi_MGk(self.dat[6][j], self.dat[7][j], fw3_lim, sig_i)
+        P_fw = []
+        Phi_fw = []
+        for k in range(self.N_mags):
+            P_fw.append(self.Normal_MGk(dat[2+2*k][j], dat[3+2*k][j], sig_fw[k]))
+            Phi_fw.append(self.Phi_MGk(dat[2+2*k][j], dat[3+2*k][j], fw_lims[k], sig_fw[k]))
 
         wr=[]
         for i in range(self.NIso):                    ## Isochrone loop
@@ -158,47 +819,60 @@ class Base():
                 # Default
                 imf_p = self.IMF_Krp(self.Iso[i][1])
 
-            Ps = P_fw1(self.Iso[i][2])*P_fw2(self.Iso[i][3])*P_fw3(self.Iso[i][4])
-            
-            Phis = Phi_fw1(self.Iso[i][2])*Phi_fw2(self.Iso[i][3])*Phi_fw3(self.Iso[i][4])
+            Ps = 1.
+            Phis = 1.
+            for k in range(self.N_mags):
+                Ps = Ps*P_fw[k](Iso[i][2+k])
+                Phis = Phis*Phi_fw[k](Iso[i][2+k])
             Intg = imf_p*Ps*Phis
 
             ## Interand
             p = trapz(Intg,self.Iso[i][1])
 
-            wr.append(str(p))
+            wr.append(p)
 
-        return ([j,wr])
+        return ([j,array(wr, dtype=float)])
 
     def C_ij_map(self, IDc):
+        if not os.path.exists('pij_cij_results'):
+            os.mkdir('pij_cij_results')
 
-        fw1_lim= self.fw_lims[0]
-        fw2_lim= self.fw_lims[1]
-        fw3_lim= self.fw_lims[2]
-        
-        sig_i = self.sig_fw[0]
-
-        filename_c = '%s_Cij_Data_LimMag%.2lf_%srows_%siso_IsoModel_sig%s_IMF_%s_Simple.txt' % \
-            (IDc,fw2_lim,str(self.N_dat),str(self.NIso),str(self.sig_fw[0]).replace('.','p'), self.IMF)
-        fp = open(os.path.join("pij_cij_results",filename_c),'a')   ## output matrix
-        args = []
-
-        # Cij is calcutated row by row, i.e. fix j-th dat and run each i-th isochrone.
-
-        for j in range(self.N_dat):    
-            args.append([j, self.dat, self.NIso, self.Iso, fw1_lim, 
-                         fw2_lim, fw3_lim, self.N_dat, filename_c, sig_i, self.IMF])
-
-        with mp.Pool(mp.cpu_count()-1) as p:
-            results = p.map(self.C_ij_row_map, args)
-            Cij_out=[]
-            for [j,wr] in results:
-                fp.write('{}'.format(' '.join(wr))+'\n')
-                Cij_out.append(array(wr, dtype=float))
-        fp.close()
-        
+        filename_c = self.pc_filename(IDc, 'Cij')
+        cached = self.engine == 'numpy' and (getattr(self, 'pc_cache', False) or getattr(self, 'stream', False))
+
+        with self.stage('Cij', rows=self.N_dat, isochrones=self.NIso):
+            if self.engine == 'numpy':
+                Cij_out, = self.block_map('C_ij_block', ['Cij'])
+            else:
+                # Cij is calcutated row by row, i.e. fix j-th dat and run each i-th isochrone.
+                with self.pool() as p:
+                    results = p.map(_pool_task, [('C_ij_row', j) for j in range(self.N_dat)])
+                Cij_out = array([wr for [j,wr] in results]).reshape(self.N_dat, self.NIso)
+
+        self.save_matrix(filename_c, Cij_out, cached)
         return(Cij_out)
 
+    def PC_ij_map(self, ID):
+        """
+            Fused Pij and Cij computation using one pool and one traversal
+            of the (star, isochrone) pairs ('numpy' engine only)
+        """
+        if not os.path.exists('pij_cij_results'):
+            os.mkdir('pij_cij_results')
+
+        filename_p = self.pc_filename(ID, 'Pij')
+        filename_c = self.pc_filename(ID, 'Cij')
+        cached = getattr(self, 'pc_cache', False) or getattr(self, 'stream', False)
+
+        with self.stage('PCij', rows=self.N_dat, isochrones=self.NIso):
+            Pij_out, Cij_out = self.block_map('PC_ij_block', ['Pij', 'Cij'])
+            if getattr(self, 'n_sig', None) is not None:
+                self.report_bound(Pij_out)
+
+        self.save_matrix(filename_p, Pij_out, cached)
+        self.save_matrix(filename_c, Cij_out, cached)
+        return([Pij_out, Cij_out, filename_p])
+
     def C_ij_row_map(self,args):
 
         j = args[0]
@@ -206,18 +880,16 @@ class Base():
         Niso = args[2]
         Iso = args[3]
 
-        fw1_lim = args[4]
-        fw2_lim = args[5]
-        fw3_lim = args[6]
+        fw_lims = args[4]
 
-        Ndat = args[7]
-        filename_c = args[8]
-        sig_i = args[9]
-        imf = args[10]
+        Ndat = args[5]
+        filename_c = args[6]
+        sig_fw = args[7]
+        imf = args[8]
 
-        phi_fw1 = self.Phi_MGk(dat[2][j], dat[3][j], fw1_lim, sig_i)
-        phi_fw2 = self.Phi_MGk(dat[4][j], dat[5][j], fw2_lim, sig_i)
-        phi_fw3 = self.Phi_MGk(dat[6][j], dat[7][j], fw2_lim, sig_i)
+        phi_fw = []
+        for k in range(self.N_mags):
+            phi_fw.append(self.Phi_MGk(dat[2+2*k][j], dat[3+2*k][j], fw_lims[k], sig_fw[k]))
 
         wr = []
         for i in range(Niso):
@@ -230,31 +902,67 @@ class Base():
             else:
                 imf_c = self.IMF_Krp(Iso[i][1])
 
-            intg_c = imf_c*phi_fw1(Iso[i][2])*phi_fw2(Iso[i][3])*phi_fw3(Iso[i][4])
+            intg_c = imf_c
+            for k in range(self.N_mags):
+                intg_c = intg_c*phi_fw[k](Iso[i][2+k])
             p_c = trapz(intg_c,Iso[i][1])
 
-            wr.append(str(p_c))
+            wr.append(p_c)
 
-        return ([j,wr])
+        return ([j,array(wr, dtype=float)])
 
-    def ai_samp(self, ID, Name):
+    def stan_model(self, dats, random_seed=1234):
+        """
+            bayestar Stan model bound to dats.
+
+            The compiled program is cached on disk by httpstan, so it is
+            built once per machine. The Model (parameter layout, which only
+            depends on the number of isochrones) is built once per process
+            and then reused with new data, skipping the build round trips.
 
+            Parameters
+            ----------
+            dats: dict,
+                  Stan data (Nj, Ni, Pij, Cij, wj)
+            random_seed: int,
+                         sampler seed
+        """
+        key = (code, int(dats['Ni']), random_seed)
+        if key not in _stan_models:
+            with self.stage('stan_build', isochrones=int(dats['Ni'])):
+                _stan_models[key] = stan.build(code, data=dats, random_seed=random_seed)
+            return _stan_models[key]
+        data = json.loads(DataJSONEncoder().encode(dats))
+        return dataclasses.replace(_stan_models[key], data=data)
+
+    def a_samp(self, Pij, Cij, wj=None):
+        """
+            Draws the isochrone weights a given Pij and Cij
+
+            Parameters
+            ----------
+            wj: array,
+                number of stars behind each row (default: one)
 
+            Returns
+            -------
+            fit: stan.fit.Fit
+        """
         ### Data for STAN ###
-        dats = {'Nj' : self.N_dat,
+        dats = {'Nj' : len(Pij),
                 'Ni' : self.NIso,
-                'Pij': self.P_ij,
-                'Cij': self.C_ij  }
+                'Pij': Pij,
+                'Cij': Cij,
+                'wj' : ones(len(Pij)) if wj is None else asarray(wj, dtype=float)  }
 
         ############ Running pystan ############
 
-        sm = stan.build(code, data=dats, random_seed=1234)
-        fit = sm.sample(num_samples=self.N_smp, num_chains=self.N_wlk, num_warmup=200)
-        self.fit = fit
-        a_sp = fit["a"].T
-
-        ######### Saving the MCMC sample #########
+        sm = self.stan_model(dats, random_seed=1234)
+        with self.stage('sampling', rows=len(Pij), chains=self.N_wlk, samples=self.N_smp):
+            return sm.sample(num_samples=self.N_smp, num_chains=self.N_wlk, num_warmup=200)
 
+    def a_save(self, a_sp, ID, Name):
+        """Writes the 10th, 50th and 90th percentiles of a per isochrone"""
         N_iso = len(a_sp[0])
 
         a_perc = array([ percentile(ai,[10,50,90]) for ai in a_sp.T])       ##  10th, 50th, 90th percentiles
@@ -265,5 +973,135 @@ class Base():
         hd='Z,Log_age,p10,p50,p90'
         filename = ID+"_ai"+Name+"_Niter"+str(len(a_sp))+".txt"
         savetxt(filename, sfh, header=hd, fmt="%.6f", delimiter=",",comments='')
-        
+
         return filename
+
+    def ai_samp(self, ID, Name):
+
+        fit = self.a_samp(self.P_ij, self.C_ij, getattr(self, 'w_dat', None))
+        self.fit = fit
+        a_sp = fit["a"].T
+
+        ######### Saving the MCMC sample #########
+
+        return self.a_save(a_sp, ID, Name)
+
+    def a_loglike(self, a, Pij, Cij, wj=None):
+        """Log-likelihood of the Stan model (flat Dirichlet prior) at weights a"""
+        wj = ones(len(Pij)) if wj is None else asarray(wj, dtype=float)
+        ll = 0.
+        for j0, j1 in self.matrix_blocks(Pij):
+            pa, ca = asarray(Pij[j0:j1], dtype=float) @ a, asarray(Cij[j0:j1], dtype=float) @ a
+            ll += wj[j0:j1] @ log(where(pa > 0, pa, 1.)) - wj[j0:j1] @ log(where(ca > 0, ca, 1.))
+        return ll
+
+    def a_map(self, Pij=None, Cij=None, a0=None, tol=1e-10, max_iter=20000, wj=None):
+        """
+            Maximum a posteriori isochrone weights a.
+
+            Uses the multiplicative (EM-like) update
+            a_i <- a_i * sum_j wj Pij/(Pj.a) / sum_j wj Cij/(Cj.a), renormalised
+            to the simplex, whose fixed points satisfy the KKT conditions
+            of the Stan model's log-likelihood. The matrices are read in
+            row blocks (matrix_blocks), so memory-mapped Pij/Cij are never
+            loaded whole.
+
+            Parameters
+            ----------
+            Pij, Cij: arrays (N, NIso),
+                      default: self.P_ij, self.C_ij
+            a0: array,
+                starting weights (default: uniform)
+            tol: float,
+                 stop when no weight changes by more than tol
+            max_iter: int,
+                      maximum number of updates
+            wj: array (N),
+                number of stars behind each row
+                (default: self.w_dat with the default matrices, else one)
+
+            Returns
+            -------
+            a: array (NIso)
+        """
+        if wj is None and Pij is None:
+            wj = getattr(self, 'w_dat', None)
+        Pij = self.P_ij if Pij is None else Pij
+        Cij = self.C_ij if Cij is None else Cij
+        wj = ones(len(Pij)) if wj is None else asarray(wj, dtype=float)
+        a = ones(Pij.shape[1])/Pij.shape[1] if a0 is None else array(a0, dtype=float)
+        blocks = self.matrix_blocks(Pij)
+
+        for it in range(max_iter):
+            num, den = zeros(len(a)), zeros(len(a))
+            for j0, j1 in blocks:
+                P, C, w = asarray(Pij[j0:j1], dtype=float), asarray(Cij[j0:j1], dtype=float), wj[j0:j1]
+                pa, ca = P @ a, C @ a
+                # Rows with Mj <= 0 do not contribute, as in the Stan model
+                num += P.T @ divide(w, pa, out=zeros(len(pa)), where=pa > 0)
+                den += C.T @ divide(w, ca, out=zeros(len(ca)), where=ca > 0)
+            a_new = a*divide(num, den, out=zeros(len(a)), where=den > 0)
+            a_new /= a_new.sum()
+            if abs(a_new - a).max() < tol:
+                a = a_new
+                break
+            a = a_new
+        return a
+
+    def ai_map(self, ID, Name, n_boot=100, seed=1234):
+        """
+            Fast alternative to ai_samp: MAP weights plus optional
+            bootstrap (stars resampled with replacement) percentiles,
+            written in the same Z,Log_age,p10,p50,p90 format
+
+            Parameters
+            ----------
+            n_boot: int,
+                    number of bootstrap resamples. With 0, the MAP weights
+                    are written in all three percentile columns
+            seed: int,
+                  bootstrap random seed
+        """
+        Pij, Cij = self.P_ij, self.C_ij
+        wj = getattr(self, 'w_dat', None)
+        wj = ones(len(Pij)) if wj is None else asarray(wj, dtype=float)
+        with self.stage('map', rows=len(Pij), n_boot=n_boot):
+            a_hat = self.a_map(Pij, Cij, wj=wj)
+            self.a_hat = a_hat
+
+            a_sp = [a_hat]
+            if n_boot > 0:
+                rng = random.default_rng(seed)
+                a_sp = []
+                n = int(round(wj.sum()))
+                for b in range(n_boot):
+                    # Star counts per row of a resample of the n stars
+                    w_b = rng.multinomial(n, wj/wj.sum())
+                    a_sp.append(self.a_map(Pij, Cij, a0=a_hat, tol=1e-8, wj=w_b))
+
+        return self.a_save(array(a_sp), ID, Name + "_MAP")
+
+    def ai_samp_batch(self, datasets, ID, Names):
+        """
+            Samples several datasets against the same compiled model
+
+            Parameters
+            ----------
+            datasets: list,
+                      (Pij, Cij) pairs, or (Pij, Cij, wj) triples for
+                      compressed rows, over this instance's isochrones,
+                      e.g. bootstrap resamples or fields
+            ID: str,
+                run ID used in the output names
+            Names: list,
+                   one output name per dataset
+
+            Returns
+            -------
+            filenames: list
+        """
+        filenames = []
+        for data, Name in zip(datasets, Names):
+            fit = self.a_samp(*data)
+            filenames.append(self.a_save(fit["a"].T, ID, Name))
+        return filenames
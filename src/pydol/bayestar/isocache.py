@@ -0,0 +1,128 @@
+from numpy import array, concatenate, cumsum, empty, load, loadtxt, save, zeros
+import hashlib, json, os, shutil
+
+cache_dir_default = os.path.join(os.path.expanduser('~'), '.cache', 'pydol', 'isochrones')
+
+def iso_stamp(filelist):
+    """(path, mtime_ns, size) of each isochrone file, used to validate a store"""
+    stamp = []
+    for k in filelist:
+        st = os.stat(k)
+        stamp.append([os.path.abspath(k), st.st_mtime_ns, st.st_size])
+    return stamp
+
+def iso_store_path(filelist, cache_dir=None):
+    """Store directory for a given (ordered) list of isochrone files"""
+    if cache_dir is None:
+        cache_dir = cache_dir_default
+    key = hashlib.sha1('\n'.join(os.path.abspath(k) for k in filelist).encode()).hexdigest()
+    return os.path.join(cache_dir, f'isogrid_{key[:16]}')
+
+def build_iso_store(filelist, store):
+    """
+        Parses every isochrone file once and writes a binary store
+
+        Parameters
+        ----------
+        filelist: list,
+                  paths to PARSEC '.isoc' files, in isochrone order
+        store: str,
+               output directory. Holds 'points.npy' (all rows of all
+               isochrones, contiguous), 'offsets.npy' (first row of each
+               isochrone, plus the total) and 'meta.json' (file stamps)
+    """
+    stamp = iso_stamp(filelist)
+    isos = [loadtxt(k, ndmin=2) for k in filelist]
+    sizes = array([len(iso) for iso in isos], dtype=int)
+    offsets = zeros(len(isos) + 1, dtype=int)
+    offsets[1:] = cumsum(sizes)
+
+    ## Written next to the final location and swapped in, so an
+    ## interrupted build never leaves a half-written store behind
+    tmp = f'{store}.tmp{os.getpid()}'
+    os.makedirs(tmp, exist_ok=True)
+    save(os.path.join(tmp, 'points.npy'), concatenate(isos).astype(float))
+    save(os.path.join(tmp, 'offsets.npy'), offsets)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({'files': stamp}, f)
+
+    if os.path.exists(store):
+        shutil.rmtree(store)
+    os.replace(tmp, store)
+
+def load_iso_store(filelist, cache_dir=None):
+    """
+        Memory-maps the binary store for filelist, (re)building it first
+        when missing or when any file changed since it was written.
+
+        Parameters
+        ----------
+        filelist: list,
+                  paths to PARSEC '.isoc' files, in isochrone order
+        cache_dir: str,
+                   directory holding the stores
+                   (default: ~/.cache/pydol/isochrones)
+
+        Returns
+        -------
+        points: array (N_rows, N_cols),
+                read-only memory map of all isochrone rows
+        offsets: array (N_iso + 1),
+                 isochrone i spans points[offsets[i]:offsets[i+1]]
+    """
+    store = iso_store_path(filelist, cache_dir)
+    try:
+        with open(os.path.join(store, 'meta.json')) as f:
+            valid = json.load(f)['files'] == iso_stamp(filelist)
+    except (OSError, ValueError, KeyError):
+        valid = False
+
+    if not valid:
+        build_iso_store(filelist, store)
+
+    points = load(os.path.join(store, 'points.npy'), mmap_mode='r')
+    offsets = load(os.path.join(store, 'offsets.npy'))
+    return points, offsets
+
+def read_isochrones(filelist, cache_dir=None, ph_sup=100, m_inf=0.1, cache=True):
+    """
+        Isochrone grid in the layout used by SFH
+
+        Parameters
+        ----------
+        filelist: list,
+                  paths to PARSEC '.isoc' files, in isochrone order
+        cache_dir: str,
+                   see load_iso_store
+        ph_sup: float,
+                highest stellar phase kept
+        m_inf: float,
+               lowest mass kept
+        cache: bool,
+               if False the files are parsed directly and nothing is stored
+
+        Returns
+        -------
+        iso: object array,
+             (7, n_i) array per isochrone: ph, mass, mag1, mag2, mag3, Z, log_age
+        Z_age_isos: array (N_iso, 2),
+                    Z and log_age of each isochrone
+    """
+    if cache:
+        points, offsets = load_iso_store(filelist, cache_dir)
+    else:
+        isos = [loadtxt(k, ndmin=2) for k in filelist]
+        points = concatenate(isos)
+        offsets = zeros(len(isos) + 1, dtype=int)
+        offsets[1:] = cumsum([len(i) for i in isos])
+
+    Z_age_isos = array(points[offsets[:-1], -2:], dtype=float)
+
+    ## mass Truncation & stellar phase Truc
+    keep = (points[:, 1] >= m_inf) & (points[:, 0] <= ph_sup)
+    iso = empty(len(filelist), dtype=object)
+    for l in range(len(filelist)):
+        i0, i1 = offsets[l], offsets[l+1]
+        iso[l] = array(points[i0:i1][keep[i0:i1]].T)
+
+    return iso, Z_age_isos
@@ -0,0 +1,81 @@
+"""
+    Fused Pij/Cij kernel for the 'numba' backend of Base.
+
+    The Gaussian x completeness x IMF integrand and its trapezoid sum are
+    evaluated point by point in one loop per star, so no (stars x points)
+    temporaries are built, and stars are spread over threads. Without
+    numba the module still imports, HAS_NUMBA is False and Base keeps
+    using the NumPy block engine.
+"""
+from math import erfc, exp, sqrt
+from numpy import empty
+
+try:
+    import numba
+    from numba import prange
+    HAS_NUMBA = True
+except ImportError:
+    numba = None
+    prange = range
+    HAS_NUMBA = False
+
+def set_threads(n):
+    """Number of threads used by the kernel in this process"""
+    if HAS_NUMBA:
+        numba.set_num_threads(max(1, min(int(n), numba.config.NUMBA_NUM_THREADS)))
+
+def pc_block(fw, fw_err, sig_i2, fw_lims, mags, w, starts, ends, cols, Pij, Cij, do_P, do_C):
+    """
+        Pij and/or Cij of a block of stars, written into Pij and Cij
+
+        Parameters
+        ----------
+        fw, fw_err: arrays (N_mags, n),
+                    star magnitudes and errors
+        sig_i2, fw_lims: arrays (N_mags),
+                         squared isochrone tolerances and magnitude limits
+        mags: array (N_mags, N_pts),
+              isochrone magnitudes (Base.iso_grid)
+        w: array (N_pts),
+           IMF x trapezoid weights
+        starts, ends, cols: arrays,
+                            point range and isochrone of every non-empty isochrone
+        Pij, Cij: arrays (n, NIso),
+                  zero-initialised outputs
+        do_P, do_C: bool,
+                    which of the two to evaluate
+    """
+    n_mags, n = fw.shape
+    sqrt2 = sqrt(2.)
+    for j in prange(n):
+        # Phi_MGk as t_k = a_k - c_k*mag, and Normal_MGk normalisation
+        a, c, b = empty(n_mags), empty(n_mags), empty(n_mags)
+        norm = 1.
+        for k in range(n_mags):
+            e2 = fw_err[k, j]*fw_err[k, j]
+            b[k] = sig_i2[k] + e2
+            s = sqrt(b[k])/sig_i2[k]
+            a[k] = (fw_lims[k] - sig_i2[k]/b[k]*fw[k, j])*s
+            c[k] = e2/b[k]*s
+            norm *= sqrt(2.*3.141592653589793*b[k])
+
+        for s_i in range(len(starts)):
+            p_sum, c_sum = 0., 0.
+            for q in range(starts[s_i], ends[s_i]):
+                phi = w[q]
+                chi2 = 0.
+                for k in range(n_mags):
+                    phi *= 0.5*erfc((c[k]*mags[k, q] - a[k])/sqrt2)
+                    if do_P:
+                        d = fw[k, j] - mags[k, q]
+                        chi2 += d*d/b[k]
+                c_sum += phi
+                if do_P:
+                    p_sum += phi*exp(-0.5*chi2)
+            if do_P:
+                Pij[j, cols[s_i]] = p_sum/norm
+            if do_C:
+                Cij[j, cols[s_i]] = c_sum
+
+if HAS_NUMBA:
+    pc_block = numba.njit(parallel=True, cache=True)(pc_block)
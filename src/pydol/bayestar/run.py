@@ -1,4 +1,5 @@
 from .core import *
+from .isocache import read_isochrones
 data_dir = Path(__file__).parent.joinpath('data')
 import pandas as pd
 
@@ -6,15 +7,105 @@ class SFH(Base):
     def __init__(self,df=None,N_wlk=20, N_smp=500, fw1_lim=30.,fw2_lim=30., fw3_lim=30.0, 
                  A_fw1=0, A_fw2=0, A_fw3=0, sig_fw1=0.1,sig_fw2=0.1, sig_fw3=0.1, 
                  dismod=29.67,isofiles='', isodir=None, ph_sup=100,m_inf=0.1,
-                 IMF='Krp',parallel=True):
+                 IMF='Krp',parallel=True, engine='numpy', block_mem=64.,
+                 n_proc=None, fused=True, iso_cache=True, iso_cache_dir=None,
+                 pc_cache=True, pc_cache_dir='pij_cij_results', text_out=False,
+                 sampler='stan', n_boot=100, n_sig=None, N_mags=3, fw_lims=None,
+                 A_fw=None, sig_fw=None, hess_tol=None, hess_err_tol=None,
+                 stream=False, max_rss=None, progress=None, progress_log=None,
+                 backend='auto'):
+        """
+            Parameters
+            ----------
+            N_mags: int,
+                    number of bands. df must hold RA, DEC and fw{k},
+                    fw{k}_error for k = 1..N_mags, and the isochrones
+                    ph, mass, one column per band, Z, log_age
+            fw_lims, A_fw, sig_fw: list,
+                                   per-band magnitude limits, extinctions and
+                                   isochrone tolerances. Required for
+                                   N_mags > 3, otherwise default to
+                                   fw{k}_lim, A_fw{k} and sig_fw{k}
+            engine: str,
+                    'numpy' evaluates Pij/Cij for blocks of stars against all
+                    isochrone points at once, 'python' loops over stars and
+                    isochrones one at a time (reference implementation)
+            backend: str,
+                     kernel of the 'numpy' engine: 'numba' runs the compiled,
+                     fused per-star loop (kernels.pc_block), 'numpy' the
+                     array blocks, 'auto' numba when it is installed
+            block_mem: float,
+                       memory cap (MB) for the temporaries of one row block
+                       in the 'numpy' engine
+            n_proc: int,
+                    number of worker processes (default: all CPUs but one)
+            fused: bool,
+                   compute Pij and Cij in a single pass sharing the
+                   completeness and IMF terms ('numpy' engine only)
+            iso_cache: bool,
+                       keep a binary, memory-mappable copy of the isochrone
+                       grid, rebuilt only when an isochrone file changes
+            iso_cache_dir: str,
+                           directory of the isochrone store
+                           (default: ~/.cache/pydol/isochrones)
+            pc_cache: bool,
+                      store Pij/Cij under a hash of their inputs, resume
+                      interrupted runs and reuse them on identical reruns
+                      ('numpy' engine only)
+            pc_cache_dir: str,
+                          directory of the Pij/Cij cache
+            text_out: bool,
+                      also export Pij/Cij as text files in pij_cij_results
+            sampler: str,
+                     'stan' runs NUTS (ai_samp), 'map' the fast MAP estimate
+                     with bootstrap percentiles (ai_map)
+            n_boot: int,
+                    bootstrap resamples for sampler='map'
+            n_sig: float,
+                   if set, Pij only integrates isochrone points within n_sig
+                   sigma of each star in fw2 (sorted-magnitude index); the
+                   error bound is reported and shrinks as exp(-n_sig**2/2)
+            hess_tol: float,
+                      if set, stars are grouped into bins of this width in
+                      every magnitude (Hess diagram cells). Each occupied bin
+                      becomes one weighted Pij/Cij row, see compress
+            hess_err_tol: float,
+                          bin width in the magnitude errors
+                          (default: hess_tol)
+            stream: bool,
+                    write Pij/Cij row blocks straight into memory maps in
+                    pc_cache_dir and keep them on disk; the MAP estimator
+                    reads them back block by block ('numpy' engine only)
+            max_rss: float,
+                     peak memory (MB) shared by all workers and the main
+                     process; lowers block_mem accordingly
+            progress: callable,
+                      called with a dict per event: stage start/end with
+                      elapsed time ('isochrones', 'Pij', 'Cij', 'PCij',
+                      'stan_build', 'sampling', 'map'), rows done, rows/s
+                      and ETA while Pij/Cij are computed, and peak RSS
+            progress_log: str,
+                          JSON-lines file the same events are appended to
+        """
         
         self.N_wlk, self.N_smp = N_wlk, N_smp
+        self.progress, self.progress_log = progress, progress_log
         
-        self.A_fw1, self.A_fw2, self.A_fw3 = A_fw1, A_fw2, A_fw3
+        self.N_mags = N_mags
         
-        self.fw_lims = array([fw1_lim,fw2_lim,fw3_lim])
+        if N_mags > 3 and (fw_lims is None or A_fw is None or sig_fw is None):
+            raise Exception("fw_lims, A_fw and sig_fw are required for N_mags > 3")
         
-        self.sig_fw = array([sig_fw1,sig_fw2,sig_fw3])
+        self.A_fw = array(A_fw if A_fw is not None else [A_fw1, A_fw2, A_fw3][:N_mags], dtype=float)
+        
+        self.dismod = dismod
+        
+        self.fw_lims = array(fw_lims if fw_lims is not None else [fw1_lim,fw2_lim,fw3_lim][:N_mags], dtype=float)
+        
+        self.sig_fw = array(sig_fw if sig_fw is not None else [sig_fw1,sig_fw2,sig_fw3][:N_mags], dtype=float)
+        
+        if not len(self.A_fw) == len(self.fw_lims) == len(self.sig_fw) == N_mags:
+            raise Exception("fw_lims, A_fw and sig_fw need one value per band")
         
         if isodir is None:
             isodir = f'{data_dir}/test_files/Isochrone.test'
@@ -35,24 +126,57 @@ class SFH(Base):
         
         #               F435W  F555W  F814W
         #   ph   mass   mag1   mag2   mag3  Z  log_age
-        iso = array([ loadtxt(k) for k in sorted(filelist) ], dtype=object)
-        
         self.ages = [float(i.split('Myr')[0].split('AGE')[1]) for i in self.filelist]
         
-        self.Z_age_isos = array([ loadtxt(k)[0][-2:] for k in sorted(self.filelist) ], dtype=object)
-        
-        ph_sup = 100
-        m_inf = 0.1
-        
-        for l in range(len(iso)):
-            iso[l] = iso[l][where( (iso[l].T[1]>=m_inf) & (iso[l].T[0]<=ph_sup))]       ## mass Truncation & stellar phase Truc
-            iso[l] = iso[l].T
+        # Parsed once into a binary store, memory-mapped on later runs
+        with self.stage('isochrones', files=len(filelist)):
+            iso, self.Z_age_isos = read_isochrones(sorted(filelist), cache_dir=iso_cache_dir,
+                                                   ph_sup=ph_sup, m_inf=m_inf,
+                                                   cache=iso_cache)
         
         self.Iso = iso
+        self.ph_sup, self.m_inf = ph_sup, m_inf
+        self.iso_cache, self.iso_cache_dir = iso_cache, iso_cache_dir
         ################################### DATA #######################################
+        self.hess_tol = hess_tol
+        self.hess_err_tol = hess_tol if hess_err_tol is None else hess_err_tol
+        self.dat, self.w_dat = self.compress(self.read_data(df))
+        
+        self.N_dat = len(self.dat[0])
+        self.NIso = len(self.Iso)
+        
+        self.parallel = parallel
+        self.IMF = IMF
+        self.engine = engine
+        self.backend = backend
+        self.block_mem = block_mem
+        self.n_proc = n_proc
+        self.fused = fused
+        self.pc_cache, self.pc_cache_dir = pc_cache, pc_cache_dir
+        self.text_out = text_out
+        self.sampler, self.n_boot = sampler, n_boot
+        self.n_sig = n_sig
+        self.stream, self.max_rss = stream, max_rss
+
+
+    def read_data(self, df=None):
+        """
+            Photometry selected by the magnitude limits and corrected for
+            distance modulus and extinction
+
+            Parameters
+            ----------
+            df: pandas.DataFrame,
+                columns RA, DEC, fw1, fw1_error, ..., fwN, fwN_error.
+                Defaults to the bundled (three-band) test catalog
+
+            Returns
+            -------
+            dat: array (2 + 2*N_mags, N)
+        """
         
         #  0      1       2        3         4          5         6          7
-        #  RA    DEC     fw1   fw1_error    fw2     fw2_error    fw3     fw3_error
+        #  RA    DEC     fw1   fw1_error    fw2     fw2_error    fw3     fw3_error   ...
         if df is None:
             df = pd.read_fwf(f"{data_dir}/test_files/data.test", sep=' ')
             col_dict = {
@@ -64,7 +188,9 @@ class SFH(Base):
                         'F814Wmag_err'    : 'fw3_error'}
 
             df = df.rename(columns=col_dict)
-        keys = ['RA','DEC','fw1','fw1_error','fw2','fw2_error','fw3','fw3_error']
+        keys = ['RA','DEC']
+        for k in range(1, self.N_mags+1):
+            keys += [f'fw{k}', f'fw{k}_error']
         try:
             dt = df[keys]
         except:
@@ -73,29 +199,82 @@ class SFH(Base):
         
         step = int(1)
         dat = dt.values.astype(float)
-        msg = "from %d... (FW1 <= %.2lf) (FW2 <= %.2lf) (FW3 <= %.2lf)" % (len(dat), fw1_lim, fw2_lim, fw3_lim)
+        msg = "from %d... " % len(dat) + ' '.join("(FW%d <= %.2lf)" % (k+1, lim) for k, lim in enumerate(self.fw_lims))
         
         # Completeness Filtering
-        dat = dat[where((dat[:,2] < fw1_lim) & (dat[:,4]  < fw2_lim) & (dat[:,6]  < fw3_lim) )]        # Truncate by apparent magnitude
+        dat = dat[(dat[:,2:2+2*self.N_mags:2] < self.fw_lims).all(axis=1)]        # Truncate by apparent magnitude
         
         #dat = dat[where((dat[:,4]  < fw2_lim))]  
         w_dat = dat[:,0]
         
         # Adding Extinction
-        dat[:,2] -= A_fw1+dismod
-        dat[:,4] -= A_fw2+dismod
-        dat[:,6] -= A_fw3+dismod
+        dat[:,2:2+2*self.N_mags:2] -= self.A_fw + self.dismod
         
         print ("Selecting %d %s" % (len(dat), msg))
         dat = dat[::step]
         dat = dat
-        self.dat = dat.T
+        return dat.T
+
+    def compress(self, dat):
+        """
+            Groups stars with magnitudes within hess_tol and errors within
+            hess_err_tol into one row at the mean of its members
+
+            Parameters
+            ----------
+            dat: array (2 + 2*N_mags, N),
+                 output of read_data
+
+            Returns
+            -------
+            dat: array (2 + 2*N_mags, N_bins),
+                 one column per occupied bin (all stars if hess_tol is None)
+            w_dat: array (N_bins),
+                   number of stars in each bin
+        """
+        if self.hess_tol is None or len(dat[0]) == 0:
+            return dat, ones(len(dat[0]))
         
-        self.N_dat = len(self.dat[0])
-        self.NIso = len(self.Iso)
+        tol = array([self.hess_tol, self.hess_err_tol]*self.N_mags, dtype=float)[:, None]
+        cells = floor(dat[2:2+2*self.N_mags]/tol).astype(int)
+        cells, inv, w_dat = unique(cells, axis=1, return_inverse=True, return_counts=True)
+        inv = inv.ravel()
         
-        self.parallel = parallel
-        self.IMF = IMF
+        dat_b = array([bincount(inv, weights=d, minlength=len(w_dat)) for d in dat])/w_dat
+        print ("Compressed %d stars into %d bins" % (len(dat[0]), len(w_dat)))
+        return dat_b, w_dat.astype(float)
+
+    def add_stars(self, df, Pij=None, Cij=None):
+        """
+            Adds stars to an existing run computing only their Pij/Cij rows
+
+            Parameters
+            ----------
+            df: pandas.DataFrame,
+                new stars, same columns as the SFH input. With hess_tol
+                they are compressed on their own and appended as new rows
+            Pij, Cij: arrays,
+                      existing matrices (default: self.P_ij, self.C_ij)
+        """
+        dat, w_dat = self.compress(self.read_data(df))
+        return self.add_rows(dat, Pij, Cij, w_dat)
+
+    def add_isochrones(self, filelist, Pij=None, Cij=None):
+        """
+            Extends the isochrone grid computing only the new Pij/Cij columns
+
+            Parameters
+            ----------
+            filelist: list,
+                      paths to the new '.isoc' files
+            Pij, Cij: arrays,
+                      existing matrices (default: self.P_ij, self.C_ij)
+        """
+        iso, Z_age_isos = read_isochrones(sorted(filelist), cache_dir=self.iso_cache_dir,
+                                          ph_sup=self.ph_sup, m_inf=self.m_inf,
+                                          cache=self.iso_cache)
+        self.filelist = list(self.filelist) + sorted(filelist)
+        return self.add_cols(iso, Z_age_isos, Pij, Cij)
 
     def __call__(self):
         ########################### Execution Routines #################################
@@ -107,12 +286,15 @@ class SFH(Base):
         
             ID = str(int(time.time()))
         
-            self.Pij_reslt = self.P_ij_map(ID)
-            self.P_ij, Pij_name = self.Pij_reslt[0], self.Pij_reslt[1]
+            if self.fused and self.engine == 'numpy':
+                self.P_ij, self.C_ij, Pij_name = self.PC_ij_map(ID)
+            else:
+                self.Pij_reslt = self.P_ij_map(ID)
+                self.P_ij, Pij_name = self.Pij_reslt[0], self.Pij_reslt[1]
             
-            Name = Pij_name[Pij_name.find("_Pij")+4:Pij_name.find(".txt")]
-        
-            self.C_ij = self.C_ij_map(ID)
+                self.C_ij = self.C_ij_map(ID)
+
+            Name = Pij_name[Pij_name.find("_Pij")+4:]
         
         else:
             print ("\tSequential mode... Not available for the moment")
@@ -127,6 +309,10 @@ class SFH(Base):
         print ("Elapsed time: %02d:%02d:%02d" % (int(elapsed / 3600.), int((elapsed % 3600)/ 60.), elapsed % 60))
         
         ###########################################
-        filename = self.ai_samp(ID, Name)
+        if self.sampler == 'map':
+            filename = self.ai_map(ID, Name, n_boot=self.n_boot)
+        else:
+            filename = self.ai_samp(ID, Name)
+        self.emit('done', elapsed=time.time() - start, output=filename)
         print("Completed!!!")
         return filename
@@ -0,0 +1,237 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from pydol.bayestar import SFH, data_dir
+from pydol.bayestar.isocache import load_iso_store, read_isochrones
+
+
+@pytest.fixture(scope='module')
+def sfh(tmp_path_factory):
+    return SFH(block_mem=1., iso_cache_dir=tmp_path_factory.mktemp('isoc'))
+
+
+def test_block_engine_matches_row_loop(sfh):
+    blocks = sfh.row_blocks()
+    assert blocks[0][0] == 0 and blocks[-1][1] == sfh.N_dat
+
+    for j0, j1 in [blocks[0], blocks[-1]]:
+        P = sfh.P_ij_block((j0, j1))
+        C = sfh.C_ij_block((j0, j1))
+        assert P.shape == C.shape == (j1 - j0, sfh.NIso)
+        for j in [j0, j1 - 1]:
+            p_row = np.array(sfh.P_ij_row(j)[1], dtype=float)
+            c_row = np.array(sfh.C_ij_row(j)[1], dtype=float)
+            assert np.allclose(P[j - j0], p_row, rtol=1e-12, atol=0)
+            assert np.allclose(C[j - j0], c_row, rtol=1e-12, atol=0)
+
+
+def test_two_band_block_matches_row_loop(tmp_path):
+    sub = SFH(block_mem=1., iso_cache_dir=tmp_path, N_mags=2,
+              fw_lims=[30., 30.], sig_fw=[0.01, 0.02], A_fw=[0., 0.])
+    assert sub.iso_grid()[0].shape[0] == 2
+
+    P = sub.P_ij_block((0, 20))
+    C = sub.C_ij_block((0, 20))
+    for j in [0, 19]:
+        assert np.allclose(P[j], np.array(sub.P_ij_row(j)[1], dtype=float), rtol=1e-12, atol=0)
+        assert np.allclose(C[j], np.array(sub.C_ij_row(j)[1], dtype=float), rtol=1e-12, atol=0)
+
+
+def test_pool_map_matches_blocks(sfh, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sub = SFH(block_mem=1., n_proc=2, iso_cache=False)
+    sub.dat = sub.dat[:, :50]
+    sub.N_dat = 50
+
+    Pij, _ = sub.P_ij_map('test')
+    Cij = sub.C_ij_map('test')
+    assert np.allclose(Pij, sfh.P_ij_block((0, 50)), rtol=1e-12, atol=0)
+    assert np.allclose(Cij, sfh.C_ij_block((0, 50)), rtol=1e-12, atol=0)
+
+    sub.engine, sub.text_out = 'python', True
+    Pij_row, name = sub.P_ij_map('test')
+    assert np.allclose(Pij_row, Pij, rtol=1e-12, atol=0)
+    assert np.array_equal(np.load(f'pij_cij_results/{name}.npy'), Pij_row)
+    assert np.array_equal(np.loadtxt(f'pij_cij_results/{name}.txt'), Pij_row)
+
+
+def test_fused_block_matches_separate(sfh):
+    rows = sfh.row_blocks()[1]
+    Pij, Cij = sfh.PC_ij_block(rows)
+    assert np.array_equal(Pij, sfh.P_ij_block(rows))
+    assert np.array_equal(Cij, sfh.C_ij_block(rows))
+
+
+def test_iso_store_matches_text_and_tracks_changes(tmp_path):
+    src = sorted((data_dir / 'test_files/Isochrone.test').glob('*.isoc'))[:2]
+    files = [str(shutil.copy(f, tmp_path)) for f in src]
+
+    iso, Z_age = read_isochrones(files, cache_dir=tmp_path / 'store')
+    iso_txt, Z_age_txt = read_isochrones(files, cache=False)
+    assert np.array_equal(Z_age, Z_age_txt)
+    for a, b in zip(iso, iso_txt):
+        assert np.array_equal(a, b)
+
+    points, offsets = load_iso_store(files, cache_dir=tmp_path / 'store')
+    with open(files[1]) as f:
+        lines = f.readlines()
+    with open(files[1], 'w') as f:
+        f.writelines(lines[:-10])
+    os.utime(files[1], ns=(0, 0))
+    points_new, offsets_new = load_iso_store(files, cache_dir=tmp_path / 'store')
+    assert offsets_new[-1] == offsets[-1] - 10
+
+
+def test_pc_cache_resumes_and_reuses(sfh, tmp_path):
+    sub = SFH(block_mem=1., n_proc=1, iso_cache=False, pc_cache_dir=str(tmp_path))
+    sub.dat = sub.dat[:, :60]
+    sub.N_dat = 60
+    Pij, Cij = sub.block_map('PC_ij_block', ['Pij', 'Cij'])
+
+    cache = tmp_path / sub.pc_key()
+    # Simulate a run interrupted after the first block
+    with open(cache / 'Cij.done') as f:
+        first = f.readline()
+    with open(cache / 'Cij.done', 'w') as f:
+        f.write(first)
+    Cij_disk = np.load(cache / 'Cij.npy', mmap_mode='r+')
+    Cij_disk[int(first.split()[1]):] = 0
+    Cij_disk.flush()
+    del Cij_disk
+
+    Pij2, Cij2 = sub.block_map('PC_ij_block', ['Pij', 'Cij'])
+    assert np.array_equal(Pij, Pij2) and np.array_equal(Cij, Cij2)
+
+    sub.sig_fw = sub.sig_fw*2
+    assert not (tmp_path / sub.pc_key()).exists()
+
+
+def test_stream_mode_stays_on_disk(sfh, tmp_path):
+    sub = SFH(n_proc=1, iso_cache=False, pc_cache=False, pc_cache_dir=str(tmp_path),
+              stream=True, max_rss=0.02)
+    sub.dat, sub.N_dat = sub.dat[:, :300], 300
+    sub.w_dat = np.ones(300)
+    Pij, Cij = sub.block_map('PC_ij_block', ['Pij', 'Cij'])
+    assert isinstance(Pij, np.memmap) and isinstance(Cij, np.memmap)
+    assert len(sub.matrix_blocks(Pij)) > 1
+
+    P, C = sfh.PC_ij_block((0, 300))
+    assert np.allclose(Pij, P, rtol=1e-12, atol=0)
+    assert np.allclose(sub.a_map(Pij, Cij), sfh.a_map(P, C), rtol=1e-10, atol=1e-14)
+
+
+def test_progress_events(tmp_path, monkeypatch):
+    events = []
+    log = tmp_path / 'progress.jsonl'
+    sub = SFH(block_mem=0.2, n_proc=1, iso_cache=False, pc_cache=False,
+              progress=events.append, progress_log=str(log))
+    sub.dat, sub.N_dat = sub.dat[:, :100], 100
+    monkeypatch.chdir(tmp_path)
+    sub.PC_ij_map('test')
+
+    stages = [(e['event'], e.get('stage')) for e in events if e['event'] != 'progress']
+    assert stages == [('stage_start', 'isochrones'), ('stage_end', 'isochrones'),
+                      ('stage_start', 'PCij'), ('stage_end', 'PCij')]
+    progress = [e for e in events if e['event'] == 'progress']
+    assert len(progress) > 1 and progress[-1]['rows_done'] == 100 and progress[-1]['eta_s'] == 0
+    assert all(e['peak_rss_mb'] > 0 for e in events)
+    with open(log) as f:
+        assert [json.loads(line)['event'] for line in f] == [e['event'] for e in events]
+
+
+def test_incremental_rows_and_cols(sfh, tmp_path):
+    full = SFH(n_proc=1, pc_cache=False, iso_cache=False)
+    full.dat, full.N_dat = full.dat[:, :40], 40
+    Pij, Cij = full.block_map('PC_ij_block', ['Pij', 'Cij'])
+
+    inc = full.subset(dat=full.dat[:, :30], Iso=full.Iso[:8])
+    inc.Z_age_isos = full.Z_age_isos[:8]
+    inc.P_ij, inc.C_ij = inc.block_map('PC_ij_block', ['Pij', 'Cij'])
+    inc.add_rows(full.dat[:, 30:])
+    inc.add_cols(full.Iso[8:], full.Z_age_isos[8:])
+    assert np.allclose(inc.P_ij, Pij, rtol=1e-12, atol=0)
+    assert np.allclose(inc.C_ij, Cij, rtol=1e-12, atol=0)
+    assert np.array_equal(inc.Z_age_isos, full.Z_age_isos)
+
+    inc.drop_rows([0, 1])
+    inc.drop_cols(0)
+    assert inc.P_ij.shape == (38, 10) and inc.dat.shape == (8, 38)
+    assert np.array_equal(inc.C_ij, Cij[2:, 1:])
+
+
+def test_a_map_satisfies_kkt(sfh):
+    Pij, Cij = sfh.PC_ij_block((0, 200))
+    a = sfh.a_map(Pij, Cij)
+    assert np.isclose(a.sum(), 1.) and (a >= 0).all()
+
+    # Gradient vanishes on the support and is non-positive off it
+    g = Pij.T @ (1/(Pij @ a)) - Cij.T @ (1/(Cij @ a))
+    on = a > 1e-6
+    assert np.allclose(g[on], 0, atol=1e-3*len(Pij))
+    assert (g[~on] <= 1e-3*len(Pij)).all()
+
+
+def test_hess_compression_matches_repeated_stars(tmp_path):
+    import pandas as pd
+    df = pd.read_fwf(f"{data_dir}/test_files/data.test", sep=' ')
+    df = df.rename(columns={'F435Wmag': 'fw1', 'F435Wmag_err': 'fw1_error',
+                            'F555Wmag': 'fw2', 'F555Wmag_err': 'fw2_error',
+                            'F814Wmag': 'fw3', 'F814Wmag_err': 'fw3_error'})
+    df = df[(df[['fw1', 'fw2', 'fw3']] < 30.).all(axis=1)].iloc[::50]
+    df = pd.concat([df]*3, ignore_index=True)
+
+    full = SFH(df=df, block_mem=1., iso_cache_dir=tmp_path)
+    comp = SFH(df=df, block_mem=1., iso_cache_dir=tmp_path, hess_tol=1e-6)
+    assert comp.N_dat == full.N_dat//3 and comp.w_dat.sum() == full.N_dat
+
+    Pf, Cf = full.PC_ij_block((0, full.N_dat))
+    Pc, Cc = comp.PC_ij_block((0, comp.N_dat))
+    a_full, a_comp = full.a_map(Pf, Cf), comp.a_map(Pc, Cc, wj=comp.w_dat)
+    assert np.allclose(a_full, a_comp, atol=1e-8)
+    assert np.isclose(full.a_loglike(a_full, Pf, Cf), comp.a_loglike(a_full, Pc, Cc, comp.w_dat))
+
+
+def test_pruned_pij_within_bound(sfh):
+    rows = (0, 300)
+    Pij = sfh.P_ij_block(rows)
+    pruned = sfh.subset()
+    pruned.n_sig = 4.
+    bound = pruned.P_ij_bound(rows)
+    for P_pruned in [pruned.P_ij_block(rows), pruned.PC_ij_block(rows)[0]]:
+        assert (P_pruned <= Pij*(1 + 1e-12)).all()
+        assert (Pij - P_pruned <= bound*(1 + 1e-12)).all()
+
+
+def test_benchmark_case(tmp_path):
+    from pydol.bayestar.benchmark import make_isochrones, make_catalog, run_case
+
+    iso_dir = make_isochrones(str(tmp_path / 'iso'), 4)
+    df = make_catalog(30, iso_dir)
+    assert len(df) == 30 and (df[['fw1', 'fw2', 'fw3']] < 30.).all().all()
+
+    rec = run_case(30, 4, str(tmp_path), n_proc=1, n_boot=2)
+    assert rec['n_rows'] == 30 and set(rec['stages']) == {'isochrones', 'PCij', 'map'}
+    assert rec['peak_rss_mb'] > 0 and json.loads(json.dumps(rec)) == rec
+
+
+def test_numba_backend_matches_numpy(sfh, monkeypatch):
+    pytest.importorskip('numba')
+    from pydol.bayestar import kernels
+
+    rows = (0, 150)
+    ref = sfh.subset()
+    ref.backend = 'numpy'
+    jit = sfh.subset()
+    jit.backend = 'numba'
+    assert jit.jit() and not ref.jit()
+    for P, P_jit in zip(ref.PC_ij_block(rows) + (ref.P_ij_block(rows), ref.C_ij_block(rows)),
+                        jit.PC_ij_block(rows) + (jit.P_ij_block(rows), jit.C_ij_block(rows))):
+        assert np.allclose(P, P_jit, rtol=1e-12, atol=0)
+
+    monkeypatch.setattr(kernels, 'HAS_NUMBA', False)
+    jit.backend = 'auto'
+    assert not jit.jit()